@@ -5,26 +5,69 @@ from textual.binding import Binding
 from textual.reactive import reactive
 from textual.message import Message
 from textual import on
+from rich.text import Text
+import asyncio
 import subprocess
-import threading
+import codecs
+from collections import deque
 import signal
 import os
+import time
 import json
+import functools
+from pathlib import Path
 from string import Template
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+@functools.lru_cache(maxsize=1)
+def _load_configs() -> dict:
+    """Read and parse config.json once, using orjson when it is available."""
+    data = Path("config.json").read_bytes()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 class ScriptConfig:
     """Configuration for a script runner."""
-    def __init__(self, name: str, command_template: str):
+
+    # Number of output lines kept in the log unless configured otherwise
+    DEFAULT_MAX_LINES = 5000
+
+    def __init__(
+        self,
+        name: str,
+        command_template: str,
+        line_buffered: bool = False,
+        max_lines: int = DEFAULT_MAX_LINES,
+    ):
         self.name = name
         self.command_template = command_template
+        # Wrap the command with stdbuf to force line-buffered stdio
+        self.line_buffered = line_buffered
+        # Number of output lines kept in the log
+        self.max_lines = max_lines
+        # Split the template once; only parts with placeholders need substitution
+        self._parts = [
+            Template(part) if Template.pattern.search(part) else part
+            for part in command_template.split()
+        ]
 
     def get_command(self, **kwargs) -> list[str]:
         """Get the command with template variables replaced."""
-        # Use Template for safe substitution
-        template = Template(self.command_template)
+        command = []
         try:
-            command_str = template.safe_substitute(**kwargs)
-            return command_str.split()
+            for part in self._parts:
+                if isinstance(part, Template):
+                    command.extend(part.safe_substitute(**kwargs).split())
+                else:
+                    command.append(part)
+            return command
         except KeyError as e:
             raise ValueError(f"Missing required template variable: {e}")
 
@@ -38,6 +81,9 @@ class ScriptRunner(Static):
             self.value = value
             super().__init__()
 
+    # Seconds to wait after SIGTERM before killing the process group
+    STOP_TIMEOUT = 3.0
+
     # Reactive properties
     script_name = reactive("Unnamed Script")
     is_running = reactive(False)
@@ -46,8 +92,18 @@ class ScriptRunner(Static):
         super().__init__(id=id, classes=classes)
         self.script_name = config.name
         self.config = config
+        # Status messages are fixed per runner, so parse their markup once
+        self._msg_launched = Text.from_markup(f"[green]{config.name} launched successfully![/]")
+        self._msg_stopped = Text.from_markup(f"[yellow]{config.name} stopped.[/]")
+        self._msg_finished = Text.from_markup(f"[yellow]{config.name} process finished.[/]")
         self.process = None
-        self.log_thread = None
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        # Partial line left over from the last read
+        self._tail = ""
+        # Output lines waiting to be flushed to the log
+        self._pending: deque[str] = deque()
+        self._flush_scheduled = False
+        self._output: RichLog | None = None
 
     def watch_is_running(self, old_value: bool, new_value: bool) -> None:
         """Handle changes in is_running state."""
@@ -55,89 +111,229 @@ class ScriptRunner(Static):
 
     def compose(self) -> ComposeResult:
         """Create child widgets."""
-        yield RichLog(id="output", wrap=True, markup=True, highlight=True)
+        yield RichLog(
+            id="output",
+            wrap=True,
+            markup=False,
+            highlight=False,
+            max_lines=self.config.max_lines,
+            auto_scroll=True,
+        )
+
+    def on_mount(self) -> None:
+        """Cache the output log once it is mounted."""
+        self._output = self.query_one("#output", RichLog)
 
     def launch_script(self, **kwargs):
         """Launch the script with template variables."""
         if self.process is not None:
+            if not self.is_running:
+                # Stopped but not reaped yet, see _release_process
+                self._write_output(f"[yellow]{self.script_name} is still stopping, try again shortly.[/]")
             return
         
         try:
             command = self.config.get_command(**kwargs)
             self.app.log(f"Launching {self.script_name}", command=command)
             
+            args = ["bash", "-c", " ".join(command)]
+            if self.config.line_buffered:
+                args = ["stdbuf", "-oL", "-eL", *args]
+
+            # Keep Python children from block-buffering output into the pipe
+            env = {**os.environ, "PYTHONUNBUFFERED": "1", "PYTHONIOENCODING": "utf-8"}
+
             self.process = subprocess.Popen(
-                ["bash", "-c", " ".join(command)],
+                args,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
-                text=True,
-                preexec_fn=os.setsid,
-                bufsize=1,
-                universal_newlines=True
+                start_new_session=True,
+                bufsize=0,
+                env=env,
             )
             
             self.is_running = True
+            self._decoder.reset()
+            self._tail = ""
             
-            # Start log monitoring thread
-            self.log_thread = threading.Thread(target=self._monitor_output, daemon=True)
-            self.log_thread.start()
+            # Read output from the event loop whenever the pipe is readable
+            fd = self.process.stdout.fileno()
+            os.set_blocking(fd, False)
+            asyncio.get_running_loop().add_reader(fd, self._on_readable, self.process)
             
-            self.query_one("#output").write(f"[green]{self.script_name} launched successfully![/]")
+            self._output.write(self._msg_launched)
         except Exception as e:
             self.app.log.error(f"Failed to launch {self.script_name}", error=str(e))
-            self.query_one("#output").write(f"[red]Failed to launch {self.script_name}: {str(e)}[/]")
+            self._write_output(f"[red]Failed to launch {self.script_name}: {str(e)}[/]")
 
     def stop_script(self):
         """Stop the script."""
-        if self.process is None:
+        if self.process is None or not self.is_running:
             return
         
+        process = self.process
         try:
             self.app.log(f"Stopping {self.script_name}")
-            os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
-            self.process = None
+            # Mark the runner as stopping before the script can react to SIGTERM
             self.is_running = False
+            # The script leads its own session, so the group id is its pid. It
+            # can't be reused while children that outlived the shell are in it
+            pgid = process.pid
+            try:
+                os.killpg(pgid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            self._close_output(process)
+
+            # Reap on the shared executor so the UI stays responsive
+            log = self.app.log
+            reaped = asyncio.get_running_loop().run_in_executor(
+                None, self._reap_process, process, pgid
+            )
+            reaped.add_done_callback(
+                lambda future: self._on_process_reaped(process, future, log)
+            )
             
-            self.query_one("#output").write(f"[yellow]{self.script_name} stopped.[/]")
+            self._flush_pending()
+            self._output.write(self._msg_stopped)
         except Exception as e:
+            self.is_running = True
             self.app.log.error(f"Error stopping {self.script_name}", error=str(e))
-            self.query_one("#output").write(f"[red]Error stopping {self.script_name}: {str(e)}[/]")
+            self._write_output(f"[red]Error stopping {self.script_name}: {str(e)}[/]")
 
-    def _monitor_output(self):
-        """Monitor and log the script output."""
-        self.app.log.debug(f"Starting output monitoring for {self.script_name}")
-        while self.is_running and self.process:
-            try:
-                line = self.process.stdout.readline()
-                if not line and self.process:
-                    if self.process.poll() is not None:
-                        self.app.log.debug(f"{self.script_name} process ended")
-                        self.is_running = False
-                        self.process = None
-                        self.app.call_from_thread(self._handle_process_exit)
-                    break
-                
-                self.app.log.debug(f"Script output", script=self.script_name, output=line.strip())
-                self.app.call_from_thread(self._write_output, line.strip())
-            except Exception as e:
-                self.app.log.error(f"Error reading output", script=self.script_name, error=str(e))
-                self.app.call_from_thread(
-                    self._write_output,
-                    f"[red]Error reading output: {str(e)}[/]"
-                )
+    def _reap_process(self, process: subprocess.Popen, pgid: int) -> bool:
+        """Wait for a stopped process group, killing it if SIGTERM is ignored.
 
-    def _write_output(self, text: str):
-        """Write text to the output log in a thread-safe way."""
-        self.query_one("#output").write(text)
+        Runs on the executor, where the app may already be gone, so it must not
+        touch self.app. Returns whether SIGKILL had to be sent.
+        """
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        try:
+            process.wait(timeout=self.STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            pass
+        # Children may outlive the shell, give them the rest of the grace period
+        while self._group_exists(pgid) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        killed = self._group_exists(pgid)
+        if killed:
+            self._force_kill(pgid)
+        process.wait()
+        return killed
+
+    def _on_process_reaped(self, process: subprocess.Popen, future: asyncio.Future, log):
+        """Report how a stopped process was reaped and release it."""
+        error = future.exception()
+        if error is not None:
+            log.error(f"Error reaping {self.script_name}", error=str(error))
+        elif future.result():
+            log.warning(f"{self.script_name} ignored SIGTERM, sent SIGKILL")
+        self._release_process(process)
+
+    def _release_process(self, process: subprocess.Popen):
+        """Forget a stopped process once it has been reaped."""
+        self._close_output(process)
+        if self.process is process:
+            self.process = None
+
+    @staticmethod
+    def _group_exists(pgid: int) -> bool:
+        """Check whether a process group still has members."""
+        try:
+            os.killpg(pgid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    @staticmethod
+    def _force_kill(pgid: int):
+        """Kill a process group, ignoring groups that are already gone."""
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _on_readable(self, process: subprocess.Popen):
+        """Read the available script output.
+
+        Reads the pipe file descriptor directly in chunks and queues every
+        complete line of a chunk in one batch, keeping any partial line for the
+        next read. Like universal newlines, "\r\n" and a lone "\r" end a line too,
+        so carriage-return progress output shows up without waiting for "\n".
+        """
+        fd = process.stdout.fileno()
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return
+        except Exception as e:
+            self.app.log.error(f"Error reading output", script=self.script_name, error=str(e))
+            self._write_output(f"[red]Error reading output: {str(e)}[/]")
+            data = b""
+
+        text = self._tail + self._decoder.decode(data, final=not data)
+        # A trailing "\r" may be the first half of a "\r\n" split across reads
+        held = ""
+        if data and text.endswith("\r"):
+            text, held = text[:-1], "\r"
+        *lines, tail = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        self._tail = tail + held
+
+        if not data and self._tail:
+            lines.append(self._tail)
+            self._tail = ""
+        if lines:
+            lines = [line.strip() for line in lines]
+            self.app.log.debug(f"Script output", script=self.script_name, lines=len(lines))
+            self._queue_lines(lines)
+
+        if not data:
+            self._close_output(process)
+            # Wait for the exit status off the event loop
+            exited = asyncio.get_running_loop().run_in_executor(None, process.wait)
+            exited.add_done_callback(lambda _: self._handle_process_exit(process))
+
+    def _close_output(self, process: subprocess.Popen):
+        """Stop reading the output of a process and close its pipe."""
+        if not process.stdout.closed:
+            asyncio.get_running_loop().remove_reader(process.stdout.fileno())
+            process.stdout.close()
 
-    def _handle_process_exit(self):
+    def _write_output(self, text: str):
+        """Write a status message with Rich markup to the output log."""
+        self._output.write(Text.from_markup(text))
+
+    def _queue_lines(self, lines: list[str]):
+        """Queue output lines for a batched flush."""
+        self._pending.extend(lines)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            # Coalesce bursts of output into a single write
+            self.set_timer(0.05, self._flush_pending)
+
+    def _flush_pending(self):
+        """Write all queued output lines to the log at once."""
+        self._flush_scheduled = False
+        if self._pending:
+            self._output.write("\n".join(self._pending))
+            self._pending.clear()
+
+    def _handle_process_exit(self, process: subprocess.Popen):
         """Handle cleanup when the process exits."""
-        self.query_one("#output").write(f"[yellow]{self.script_name} process finished.[/]")
+        if self.process is not process or not self.is_running:
+            # Stopped meanwhile, stop_script releases the process
+            return
+        self.app.log.debug(f"{self.script_name} process ended")
+        self._close_output(process)
+        self.process = None
+        self.is_running = False
+        self._flush_pending()
+        self._output.write(self._msg_finished)
         self.app.log(f"{self.script_name} process cleanup completed")
 
     def clear_output(self):
         """Clear the output log."""
-        self.query_one("#output").clear()
+        self._output.clear()
     
     def on_unmount(self) -> None:
         """Clean up when the widget is unmount."""
@@ -160,18 +356,37 @@ class AlohaConsole(App):
     def __init__(self):
         super().__init__()
         self.script_configs = self._load_config()
+        self._tabs: Tabs | None = None
+        self._episode_input: Input | None = None
+        # Set while the episode is being updated from the episode input
+        self._episode_from_input = False
+        self._launch_buttons: dict[str, Button] = {}
+        self._stop_buttons: dict[str, Button] = {}
+        self._runners: dict[str, ScriptRunner] = {}
+        self._tab_to_runner: dict[str, str] = {}
+        # The runner shown at start up, see compose
+        self._active_runner_id = "core-runner"
 
     def _load_config(self) -> dict[str, ScriptConfig]:
         """Load script configurations from config file."""
         try:
-            with open("config.json", "r") as f:
-                config_data = json.load(f)
+            config_data = _load_configs()
             
             configs = {}
             for script_id, script_config in config_data["scripts"].items():
+                max_lines = script_config.get("max_lines", ScriptConfig.DEFAULT_MAX_LINES)
+                if isinstance(max_lines, bool) or not isinstance(max_lines, int) or max_lines <= 0:
+                    self.log.error(
+                        f"Invalid max_lines for {script_id}: {max_lines!r}, "
+                        f"using {ScriptConfig.DEFAULT_MAX_LINES}"
+                    )
+                    max_lines = ScriptConfig.DEFAULT_MAX_LINES
+
                 configs[script_id] = ScriptConfig(
                     name=script_config["name"],
-                    command_template=script_config["command"]
+                    command_template=script_config["command"],
+                    line_buffered=script_config.get("line_buffered", False),
+                    max_lines=max_lines
                 )
             return configs
         except Exception as e:
@@ -221,72 +436,95 @@ class AlohaConsole(App):
         self.query_one("#data-runner #output").write("Welcome to Data Collection! 📊\n")
         self.query_one("#sleep-runner #output").write("Welcome to Sleep Arm! 💤\n")
 
+        # Cache widgets used by the event handlers
+        self._tabs = self.query_one(Tabs)
+        self._episode_input = self.query_one("#episode-input", Input)
+        for runner_type in ("core", "data", "sleep"):
+            self._launch_buttons[runner_type] = self.query_one(f"#launch-{runner_type}", Button)
+            self._stop_buttons[runner_type] = self.query_one(f"#stop-{runner_type}", Button)
+            self._tab_to_runner[f"{runner_type}-tab"] = f"{runner_type}-runner"
+        self._runners = {runner.id: runner for runner in self.query(ScriptRunner)}
+
         # Set initial tab
         self._show_runner_for_tab("core-tab")
 
     def watch_episode(self, old_value: int, new_value: int) -> None:
         """Update episode input when episode number changes."""
-        self.query_one("#episode-input").value = str(new_value)
+        if old_value == new_value or self._episode_from_input:
+            return
+        if self._episode_input is not None:
+            self._episode_input.value = str(new_value)
 
     @on(Input.Changed, "#episode-input")
     def handle_episode_input(self, event: Input.Changed) -> None:
         """Handle episode input changes."""
+        value = event.value
+        if value == str(self.episode) or not event.validation_result.is_valid:
+            return
+
         try:
-            if event.validation_result.is_valid:
-                self.episode = int(event.value)
+            episode = int(value)
         except ValueError:
             # Reset to previous value on invalid input
             self.app.log.error("Invalid episode number")
             event.input.value = str(self.episode)
+            return
+
+        # The input already shows this value, don't write it back
+        self._episode_from_input = True
+        try:
+            self.episode = episode
+        finally:
+            self._episode_from_input = False
 
     @on(Button.Pressed, "#next-button")
     def handle_next_button(self) -> None:
         """Handle next button press."""
         self.episode += 1
         self._launch_data_collection()
-        self.query_one(Tabs).active = "data-tab"
+        self._tabs.active = "data-tab"
 
     @on(Button.Pressed, "#launch-data")
     def handle_launch_data_button(self) -> None:
         """Handle launch data collection button press."""
         self._launch_data_collection()
-        self.query_one(Tabs).active = "data-tab"
+        self._tabs.active = "data-tab"
 
     @on(Button.Pressed, "#stop-data")
     def handle_stop_data_button(self) -> None:
         """Handle stop data collection button press."""
-        runner = self.query_one("#data-runner", ScriptRunner)
+        runner = self._runners["data-runner"]
         runner.stop_script()
 
     @on(Button.Pressed, "#launch-core")
     def handle_launch_core_button(self) -> None:
         """Handle launch core button press."""
-        runner = self.query_one("#core-runner", ScriptRunner)
+        runner = self._runners["core-runner"]
         runner.launch_script()
-        self.query_one(Tabs).active = "core-tab"
+        self._tabs.active = "core-tab"
 
     @on(Button.Pressed, "#stop-core")
     def handle_stop_core_button(self) -> None:
         """Handle stop core button press."""
-        runner = self.query_one("#core-runner", ScriptRunner)
+        runner = self._runners["core-runner"]
         runner.stop_script()
 
     @on(Button.Pressed, "#launch-sleep")
     def handle_launch_sleep_button(self) -> None:
         """Handle launch sleep arm button press."""
-        runner = self.query_one("#sleep-runner", ScriptRunner)
+        runner = self._runners["sleep-runner"]
         runner.launch_script()
-        self.query_one(Tabs).active = "sleep-tab"
+        self._tabs.active = "sleep-tab"
 
     @on(Button.Pressed, "#stop-sleep")
     def handle_stop_sleep_button(self) -> None:
         """Handle stop sleep arm button press."""
-        runner = self.query_one("#sleep-runner", ScriptRunner)
+        runner = self._runners["sleep-runner"]
         runner.stop_script()
 
     def _launch_data_collection(self) -> None:
         """Launch data collection with current episode number."""
-        runner = self.query_one("#data-runner", ScriptRunner)
+        runner = self._runners["data-runner"]
         runner.launch_script(episode=str(self.episode))
 
     @on(Tabs.TabActivated)
@@ -296,14 +534,15 @@ class AlohaConsole(App):
             self._show_runner_for_tab(event.tab.id)
 
     def _show_runner_for_tab(self, tab_id: str) -> None:
-        """Show the runner for the selected tab and hide others."""
-        # Query all script runners
-        script_runners = self.query(ScriptRunner)
-        runner_id = tab_id.replace("-tab", "-runner")
+        """Show the runner for the selected tab and hide the previous one."""
+        runner_id = self._tab_to_runner.get(tab_id)
+        if runner_id is None or runner_id == self._active_runner_id:
+            return
 
-        # Show the selected runner and hide others
-        for runner in script_runners:
-            runner.set_class(runner.id != runner_id, "hidden")
+        # Only the previously shown and newly selected runners change
+        self._runners[self._active_runner_id].add_class("hidden")
+        self._runners[runner_id].remove_class("hidden")
+        self._active_runner_id = runner_id
 
     @on(ScriptRunner.RunningStatusChanged)
     def handle_runner_status(self, event: ScriptRunner.RunningStatusChanged) -> None:
@@ -313,8 +552,8 @@ class AlohaConsole(App):
             return
             
         runner_type = runner_id.replace("-runner", "")
-        launch_button = self.query_one(f"#launch-{runner_type}", Button)
-        stop_button = self.query_one(f"#stop-{runner_type}", Button)
+        launch_button = self._launch_buttons[runner_type]
+        stop_button = self._stop_buttons[runner_type]
         
         # Toggle visibility using CSS classes
         launch_button.disabled = event.value
@@ -324,9 +563,7 @@ class AlohaConsole(App):
 
     def action_clear(self) -> None:
         """Clear the console output."""
-        visible_runner = self.query(ScriptRunner).exclude(".hidden").first()
-        if visible_runner:
-            visible_runner.clear_output()
+        self._runners[self._active_runner_id].clear_output()
 
     def on_unmount(self) -> None:
         """Clean up when the app is closing."""